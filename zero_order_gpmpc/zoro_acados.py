@@ -1,4 +1,5 @@
 import os, sys
+import hashlib
 import numpy as np
 import casadi as cas
 
@@ -8,8 +9,39 @@ import gpytorch
 from acados_template import AcadosOcp, AcadosSim, AcadosSimSolver, AcadosOcpSolver
 from .zoro_acados_utils import *
 
+from glob import glob
 from time import perf_counter
+from copy import deepcopy
 from dataclasses import dataclass
+from enum import IntEnum
+
+class Tkey(IntEnum):
+    """
+    Row indices of the timings array, names are the (lowercase) timing keys.
+    PHASE_ONE is no longer recorded, both SQP-RTI phases run in one call and are
+    timed in SOLVE_QP; it is only kept in solve_stats["timings"] for compatibility
+    and neither printed nor returned by get_solve_stats().
+    """
+    BUILD_LIN_MODEL = 0
+    QUERY_NODES = 1
+    GET_GP_SENSITIVITIES = 2
+    INTEGRATE_ACADOS = 3
+    INTEGRATE_ACADOS_PYTHON = 4
+    INTEGRATE_GET = 5
+    INTEGRATE_SET = 6
+    SET_SENSITIVITIES = 7
+    SET_SENSITIVITIES_RESHAPE = 8
+    PROPAGATE_COVAR = 9
+    GET_BACKOFFS = 10
+    GET_BACKOFFS_HTJ_SIG = 11
+    GET_BACKOFFS_HTJ_SIG_MATMUL = 12
+    GET_BACKOFFS_ADD = 13
+    SET_TIGHTENING = 14
+    PHASE_ONE = 15
+    CHECK_TERMINATION = 16
+    SOLVE_QP = 17
+    SOLVE_QP_ACADOS = 18
+    TOTAL = 19
 
 @dataclass
 class ZoroAcadosData:
@@ -27,7 +59,7 @@ class ZoroAcados():
         use_cython=True, 
         h_tightening_jac_sig_fun=None,
         h_tightening_idx=[],
-        path_json_ocp="zoro_sim_solver_config.json",
+        path_json_ocp="zoro_ocp_solver_config.json",
         path_json_sim="zoro_sim_solver_config.json"
     ):
         """
@@ -45,7 +77,9 @@ class ZoroAcados():
         self.nx = nx
         self.nu = nu
         self.nparam = nparam
-        self.nparam_model = nparam - int((self.nx+1)*self.nx/2)
+        self._nx_vec = self.nx*(self.nx+1)//2
+        self._triu_i, self._triu_j = np.triu_indices(self.nx)
+        self.nparam_model = nparam - self._nx_vec
         self.N = N
         self.T = T
         self.sim = sim
@@ -55,7 +89,7 @@ class ZoroAcados():
             B = np.eye(self.nx)
         
         self.nw = B.shape[1]
-        self.B = B
+        self.B = np.ascontiguousarray(B)
         self.Sigma_x0 = Sigma_x0
         self.Sigma_W = Sigma_W
 
@@ -63,14 +97,25 @@ class ZoroAcados():
         self.x_hat_all = np.zeros((N+1, nx))
         self.u_hat_all = np.zeros((N, nu))
         self.y_hat_all = np.zeros((N,nx+nu))
-        self.P_bar_all = [None] * (N+1)
-        self.P_bar_all_vec = [None] * (N+1)
+        self.P_bar_all = np.empty((N+1, nx, nx))
+        self.P_bar_all_vec = np.empty((N+1, self._nx_vec))
         self.P_bar_old_vec = None
-        self.P_bar_all[0] = Sigma_x0
-        self.P_bar_all_vec[0] = sym_mat2vec(Sigma_x0)
+        self._P_bar_all_vec_set = False
+        self.P_bar_all[0,:,:] = Sigma_x0
+        self.P_bar_all_vec[0,:] = Sigma_x0[self._triu_i, self._triu_j]
         self.mean = np.zeros((N, self.nw))
         self.mean_dy = np.zeros((self.nw, N, nx+nu))
         self.var = np.zeros((N,self.nw))
+        self.A_nom_all = np.zeros((N, nx, nx))
+        self.B_nom_all = np.zeros((N, nx, nu))
+        self.x_nom_all = np.zeros((N, nx))
+
+        # process noise of all stages, B (Sigma_W + diag(var)) B^T
+        self.BWBT_all = np.zeros((N, nx, nx))
+
+        # scratch buffers for covariance propagation
+        self._AP = np.empty((nx, nx))
+        self._APAT = np.empty((nx, nx))
 
         # TODO: allow for more general model structures (other params than just vectorized covariances)
         if h_tightening_jac_sig_fun is None:
@@ -81,6 +126,7 @@ class ZoroAcados():
         # else:
         
         self.h_tightening_jac_sig_fun = h_tightening_jac_sig_fun
+        self.h_tightening_jac_sig_map = h_tightening_jac_sig_fun.map(N, "thread", max(1, (os.cpu_count() or 2)//2))
 
         self.ocp = transform_ocp(ocp)
         self.nparam_zoro = self.ocp.dims.np
@@ -88,16 +134,20 @@ class ZoroAcados():
         self.p_hat_model_with_Pvec = np.zeros((N+1,self.nparam))
         self.p_hat_all = np.zeros((N,self.nparam_zoro))
 
-        self.p_hat_model_with_Pvec[0,:int((self.nx+1)*self.nx/2)] = self.P_bar_all_vec[0]
+        # linear model as views into p_hat_all, such that A_total_all[k] and
+        # B_total_all[k] are stored in the column-major order expected by acados
+        self.A_total_all = self.p_hat_all[:,0:nx**2].reshape((N,nx,nx)).transpose((0,2,1))
+        self.B_total_all = self.p_hat_all[:,nx**2:nx**2+nx*nu].reshape((N,nu,nx)).transpose((0,2,1))
+        self.f_hat_all = self.p_hat_all[:,nx**2+nx*nu:nx**2+nx*nu+nx]
+        self._idx_p_Pvec = nx**2+nx*nu+nx
+        self._zero_tightening = np.zeros((N, self.ocp.dims.nh))
+        self.tol_dP_bar = 1e-12
 
-        if use_cython:
-            AcadosOcpSolver.generate(self.ocp, json_file = path_json_ocp)
-            AcadosOcpSolver.build(self.ocp.code_export_directory, with_cython=True)
-            self.ocp_solver = AcadosOcpSolver.create_cython_solver(path_json_ocp)
+        self.p_hat_model_with_Pvec[0,:self._nx_vec] = self.P_bar_all_vec[0,:]
 
-            AcadosSimSolver.generate(self.sim, json_file = path_json_sim)
-            AcadosSimSolver.build(self.sim.code_export_directory, with_cython=True)
-            self.sim_solver = AcadosSimSolver.create_cython_solver(path_json_sim)
+        if use_cython:
+            self.ocp_solver = self._create_cython_solver(AcadosOcpSolver, self.ocp, path_json_ocp, "ocp")
+            self.sim_solver = self._create_cython_solver(AcadosSimSolver, self.sim, path_json_sim, "sim")
         else:
             self.ocp_solver = AcadosOcpSolver(self.ocp, json_file = path_json_ocp)
             self.sim_solver = AcadosSimSolver(self.sim, json_file = path_json_sim)
@@ -110,33 +160,14 @@ class ZoroAcados():
             self.gp_sensitivities = generate_gp_funs(gp_model)
 
         # timings
+        self._profile = False
         self.solve_stats_default = {
             "n_iter": 0,
             "timings_total": 0.0,
-            "timings": {
-                "build_lin_model": 0.0,
-                "query_nodes": 0.0,
-                "get_gp_sensitivities": 0.0,
-                "integrate_acados": 0.0,
-                "integrate_acados_python": 0.0,
-                "integrate_get": 0.0,
-                "integrate_set": 0.0,
-                "set_sensitivities": 0.0,
-                "set_sensitivities_reshape": 0.0,
-                "propagate_covar": 0.0,
-                "get_backoffs": 0.0,
-                "get_backoffs_htj_sig": 0.0,
-                "get_backoffs_htj_sig_matmul": 0.0,
-                "get_backoffs_add": 0.0,
-                "set_tightening": 0.0,
-                "phase_one": 0.0,
-                "check_termination": 0.0,
-                "solve_qp": 0.0,
-                "solve_qp_acados": 0.0,
-                "total": 0.0,
-            }
+            "timings": {k.name.lower(): 0.0 for k in Tkey}
         }
-        self.solve_stats = self.solve_stats_default.copy()
+        self.solve_stats = deepcopy(self.solve_stats_default)
+        self._timings_arr = None
 
     def solve(self, tol_nlp=1e-6, n_iter_max=30):
         time_total = perf_counter()
@@ -149,160 +180,206 @@ class ZoroAcados():
         nw = self.nw
         N = self.N
 
+        # constant part of the process noise, read on every call such that B and Sigma_W can be changed between solves
+        B_Sigma_W_BT = self.B @ self.Sigma_W @ self.B.T
+
+        # timings are only recorded when profiling
+        profile = self._profile
+        timings = self._timings_arr
+
+        # preparation and feedback rti_phase in one call (solve() AFTER setting params to get right Jacobians)
+        self.ocp_solver.options_set('rti_phase', 0)
+
         for i in range(n_iter_max):
-            time_iter = perf_counter()
             # ------------------- Query nodes --------------------
-            time_query_nodes = perf_counter()
-            # preparation rti_phase (solve() AFTER setting params to get right Jacobians)
-            self.ocp_solver.options_set('rti_phase', 1)
-
+            if profile:
+                time_iter = perf_counter()
+                time_query_nodes = time_iter
             # get sensitivities for all stages
             for stage in range(self.N):
                 # current stage values
                 self.x_hat_all[stage,:] = self.ocp_solver.get(stage,"x")   
                 self.u_hat_all[stage,:] = self.ocp_solver.get(stage,"u")   
-                self.y_hat_all[stage,:] = np.hstack((self.x_hat_all[stage,:],self.u_hat_all[stage,:])).reshape((1,nx+nu))   
 
-            self.solve_stats["timings"]["query_nodes"][i] += perf_counter() - time_query_nodes
+            np.concatenate((self.x_hat_all[0:N,:], self.u_hat_all), axis=1, out=self.y_hat_all)
+
+            if profile:
+                timings[Tkey.QUERY_NODES,i] += perf_counter() - time_query_nodes
             
             # ------------------- GP Sensitivities --------------------
-            time_get_gp_sensitivities = perf_counter()
+            if profile:
+                time_get_gp_sensitivities = perf_counter()
 
             if self.has_gp_model:
-                torch.cuda.synchronize()
+                if profile and torch.cuda.is_available():
+                    torch.cuda.synchronize()
                 self.mean, self.mean_dy, self.var = self.gp_sensitivities(self.y_hat_all)
-                torch.cuda.synchronize()
+                if profile and torch.cuda.is_available():
+                    torch.cuda.synchronize()
 
-            self.solve_stats["timings"]["get_gp_sensitivities"][i] += perf_counter() - time_get_gp_sensitivities
+            if profile:
+                timings[Tkey.GET_GP_SENSITIVITIES,i] += perf_counter() - time_get_gp_sensitivities
             
-            # ------------------- Update stages --------------------
+            # ------------------- Integrate --------------------
             for stage in range(self.N):
-                # set parameters (linear matrices and offset)
-                # ------------------- Integrate --------------------
-                time_integrate_set = perf_counter()
+                if profile:
+                    time_integrate_set = perf_counter()
                 self.sim_solver.set("x", self.x_hat_all[stage,:])
                 self.sim_solver.set("u", self.u_hat_all[stage,:])
                 self.sim_solver.set("p", self.p_hat_model_with_Pvec[stage,:])
-                self.solve_stats["timings"]["integrate_set"][i] += perf_counter() - time_integrate_set
+                if profile:
+                    timings[Tkey.INTEGRATE_SET,i] += perf_counter() - time_integrate_set
+                    time_integrate_acados_python = perf_counter()
 
-                time_integrate_acados_python = perf_counter()
                 status_integrator = self.sim_solver.solve()
-                self.solve_stats["timings"]["integrate_acados_python"][i] += perf_counter() - time_integrate_acados_python
-                self.solve_stats["timings"]["integrate_acados"][i] += self.sim_solver.get("time_tot")
 
-                time_integrate_get = perf_counter()
-                A_nom = self.sim_solver.get("Sx")
-                B_nom = self.sim_solver.get("Su")
-                x_nom = self.sim_solver.get("x")
-                self.solve_stats["timings"]["integrate_get"][i] += perf_counter() - time_integrate_get
+                if profile:
+                    timings[Tkey.INTEGRATE_ACADOS_PYTHON,i] += perf_counter() - time_integrate_acados_python
+                    timings[Tkey.INTEGRATE_ACADOS,i] += self.sim_solver.get("time_tot")
+                    time_integrate_get = perf_counter()
+
+                self.A_nom_all[stage,:,:] = self.sim_solver.get("Sx")
+                self.B_nom_all[stage,:,:] = self.sim_solver.get("Su")
+                self.x_nom_all[stage,:] = self.sim_solver.get("x")
+
+                if profile:
+                    timings[Tkey.INTEGRATE_GET,i] += perf_counter() - time_integrate_get
 
-                # ------------------- Build linear model --------------------
+            # ------------------- Build linear model --------------------
+            if profile:
                 time_build_lin_model = perf_counter()
 
-                A_total = A_nom + self.B @ self.mean_dy[:,stage,0:nx]
-                B_total = B_nom + self.B @ self.mean_dy[:,stage,nx:nx+nu]
+            # batched over all stages: (nx,nw) x (nw,N,.) -> (N,nx,.)
+            np.add(self.A_nom_all, np.einsum("ij,jkl->kil", self.B, self.mean_dy[:,:,0:nx]), out=self.A_total_all)
+            np.add(self.B_nom_all, np.einsum("ij,jkl->kil", self.B, self.mean_dy[:,:,nx:nx+nu]), out=self.B_total_all)
 
-                f_hat = x_nom + self.B @ self.mean[stage,:] \
-                    - A_total @ self.x_hat_all[stage,:] - B_total @ self.u_hat_all[stage,:]
+            self.f_hat_all[:,:] = self.x_nom_all + self.mean @ self.B.T \
+                - np.einsum("kij,kj->ki", self.A_total_all, self.x_hat_all[0:N,:]) \
+                - np.einsum("kij,kj->ki", self.B_total_all, self.u_hat_all)
 
-                self.solve_stats["timings"]["build_lin_model"][i] += perf_counter() - time_build_lin_model
-                
-                # ------------------- Propagate --------------------
+            if profile:
+                timings[Tkey.BUILD_LIN_MODEL,i] += perf_counter() - time_build_lin_model
+
+            # ------------------- Propagate --------------------
+            if profile:
                 time_propagate_covar = perf_counter()
 
-                # delta-Values
-                if self.P_bar_old_vec is None:
-                    # i == 0
-                    dP_bar_vec = cas.DM.zeros((int((nx+1)*nx/2),1))
-                else:
-                    dP_bar_vec = self.P_bar_all_vec[stage] - self.P_bar_old_vec
+            # covariances of previous iteration (stages > 0 are only set after first propagation)
+            self.P_bar_old_vec = self.P_bar_all_vec.copy() if self._P_bar_all_vec_set else None
 
-                self.P_bar_all[stage+1] = P_propagation(self.P_bar_all[stage], A_total, self.B, self.Sigma_W + np.diag(self.var[stage,:]))
-                
-                self.P_bar_old_vec = self.P_bar_all_vec[stage+1] # used in next iter
-                self.P_bar_all_vec[stage+1] = sym_mat2vec(self.P_bar_all[stage+1])
-                self.p_hat_model_with_Pvec[stage+1,:int((self.nx+1)*self.nx/2)] = self.P_bar_all_vec[stage+1]
+            # non-recursive part for all stages at once
+            np.add(B_Sigma_W_BT, np.einsum("ij,kj,lj->kil", self.B, self.var, self.B), out=self.BWBT_all)
+
+            for stage in range(self.N):
+                self._propagate_inplace(self.P_bar_all[stage+1,:,:], self.P_bar_all[stage,:,:], self.A_total_all[stage,:,:], self.BWBT_all[stage,:,:])
 
-                self.solve_stats["timings"]["propagate_covar"][i] += perf_counter() - time_propagate_covar
+            self.P_bar_all_vec[1:,:] = self.P_bar_all[1:,self._triu_i,self._triu_j]
 
-                # ------------------- Set sensitivities --------------------
+            self.p_hat_model_with_Pvec[1:,:self._nx_vec] = self.P_bar_all_vec[1:,:]
+            self._P_bar_all_vec_set = True
+
+            if profile:
+                timings[Tkey.PROPAGATE_COVAR,i] += perf_counter() - time_propagate_covar
+
+            # ------------------- Set sensitivities --------------------
+            # linear model is already written into p_hat_all, see __init__
+            if profile:
                 time_set_sensitivities_reshape = perf_counter()
 
-                A_reshape = np.reshape(A_total,(nx**2),order="F")
-                B_reshape = np.reshape(B_total,(nx*nu),order="F")
-                
-                self.solve_stats["timings"]["set_sensitivities_reshape"][i] += perf_counter() - time_set_sensitivities_reshape
+            self.p_hat_all[:,self._idx_p_Pvec:self._idx_p_Pvec+self._nx_vec] = self.P_bar_all_vec[0:N,:]
+            self.p_hat_all[:,self._idx_p_Pvec+self._nx_vec:] = self.p_hat_model
+
+            if profile:
+                timings[Tkey.SET_SENSITIVITIES_RESHAPE,i] += perf_counter() - time_set_sensitivities_reshape
                 time_set_sensitivities = perf_counter()
 
-                self.p_hat_all[stage,:] = np.hstack((
-                    A_reshape,
-                    B_reshape,
-                    f_hat,
-                    self.P_bar_all_vec[stage],
-                    self.p_hat_model[stage,:]
-                ))
+            for stage in range(self.N):
                 self.ocp_solver.set(stage, "p", self.p_hat_all[stage,:])
-                self.solve_stats["timings"]["set_sensitivities"][i] += perf_counter() - time_set_sensitivities
 
-                # ------------------- Compute back off --------------------
+            if profile:
+                timings[Tkey.SET_SENSITIVITIES,i] += perf_counter() - time_set_sensitivities
+
+            # ------------------- Compute back off --------------------
+            if profile:
                 time_get_backoffs = perf_counter()
 
-                time_get_backoffs_htj_sig = perf_counter()
-                p_sig = np.hstack((
-                    self.P_bar_all_vec[stage], 
-                    self.p_hat_model[i,:]
-                ))
-                htj_sig = self.h_tightening_jac_sig_fun(self.x_hat_all[stage,:], self.u_hat_all[stage,:], p_sig)          
-                self.solve_stats["timings"]["get_backoffs_htj_sig"][i] += perf_counter() - time_get_backoffs_htj_sig
-                
-                time_get_backoffs_htj_sig_matmul = perf_counter()
-                htj_sig_matmul = htj_sig @ dP_bar_vec         
-                self.solve_stats["timings"]["get_backoffs_htj_sig_matmul"][i] += perf_counter() - time_get_backoffs_htj_sig_matmul
+            if self.P_bar_old_vec is None:
+                # i == 0: no covariance update, hence no change in tightening
+                tightening_all = self._zero_tightening
+            else:
+                # delta-Values
+                dP_bar_all_vec = self.P_bar_all_vec[0:N,:] - self.P_bar_old_vec[0:N,:]
 
+                # stages with (numerically) unchanged covariances do not change the tightening
+                stages_converged = np.max(np.abs(dP_bar_all_vec), axis=1) < self.tol_dP_bar
+                if np.all(stages_converged):
+                    tightening_all = self._zero_tightening
+                else:
+                    dP_bar_all_vec[stages_converged,:] = 0.0
+
+                    # all stages in one (parallel) call, horizontally concatenated
+                    if profile:
+                        time_get_backoffs_htj_sig = perf_counter()
+                    p_sig_all = np.hstack((
+                        self.P_bar_all_vec[0:N,:],
+                        self.p_hat_model
+                    ))
+                    htj_sig_all = self.h_tightening_jac_sig_map(self.x_hat_all[0:N,:].T, self.u_hat_all.T, p_sig_all.T)
+                    if profile:
+                        timings[Tkey.GET_BACKOFFS_HTJ_SIG,i] += perf_counter() - time_get_backoffs_htj_sig
+                        time_get_backoffs_htj_sig_matmul = perf_counter()
+
+                    htj_sig_all = htj_sig_all.full().reshape((-1, N, self._nx_vec))
+                    tightening_all = np.einsum("hkj,kj->kh", htj_sig_all, dP_bar_all_vec)
+
+                    if profile:
+                        timings[Tkey.GET_BACKOFFS_HTJ_SIG_MATMUL,i] += perf_counter() - time_get_backoffs_htj_sig_matmul
+
+            if profile:
                 time_get_backoffs_add = perf_counter()
-                tightening = htj_sig_matmul
 
-                lh = cas.DM(self.ocp.constraints.lh) + tightening 
+            lh_all = self.ocp.constraints.lh + tightening_all
 
+            if profile:
                 time_now = perf_counter()
-                self.solve_stats["timings"]["get_backoffs_add"][i] = time_now - time_get_backoffs_add
-                self.solve_stats["timings"]["get_backoffs"][i] += time_now - time_get_backoffs
-                
-                # ------------------- Set tightening --------------------
-                time_set_tightening = perf_counter()
+                timings[Tkey.GET_BACKOFFS_ADD,i] += time_now - time_get_backoffs_add
+                timings[Tkey.GET_BACKOFFS,i] += time_now - time_get_backoffs
 
-                # set constraints
-                self.ocp_solver.constraints_set(stage,"lh",lh.full().flatten())
+            # ------------------- Set tightening --------------------
+            if profile:
+                time_set_tightening = perf_counter()
 
-                self.solve_stats["timings"]["set_tightening"][i] += perf_counter() - time_set_tightening
-                # self.solve_stats["timings"]["set_tightening_raw"][i] += t_set_C + t_set_lg + t_set_ug
+            # set constraints
+            for stage in range(self.N):
+                self.ocp_solver.constraints_set(stage,"lh",lh_all[stage,:])
 
-            # feedback rti_phase
-            # self.ocp_solver.options_set('rti_phase', 1)
-            # ------------------- Phase 1 --------------------
-            time_phase_one = perf_counter()
-            status = self.ocp_solver.solve()
-            self.solve_stats["timings"]["phase_one"][i] += perf_counter() - time_phase_one
+            if profile:
+                timings[Tkey.SET_TIGHTENING,i] += perf_counter() - time_set_tightening
 
             # ------------------- Solve QP --------------------
-            time_solve_qp = perf_counter()
+            # preparation (phase one) and feedback, both timed in solve_qp
+            if profile:
+                time_solve_qp = perf_counter()
 
-            self.ocp_solver.options_set('rti_phase', 2)
             status = self.ocp_solver.solve()
                 
-            self.solve_stats["timings"]["solve_qp"][i] += perf_counter() - time_solve_qp
-            self.solve_stats["timings"]["solve_qp_acados"][i] += self.ocp_solver.get_stats("time_tot")
+            if profile:
+                timings[Tkey.SOLVE_QP,i] += perf_counter() - time_solve_qp
+                timings[Tkey.SOLVE_QP_ACADOS,i] += self.ocp_solver.get_stats("time_tot")
 
             # ------------------- Check termination --------------------
             # check on residuals and terminate loop.
-            time_check_termination = perf_counter()
+            if profile:
+                time_check_termination = perf_counter()
             
             # self.ocp_solver.print_statistics() # encapsulates: stat = self.ocp_solver.get_stats("statistics")
             residuals = self.ocp_solver.get_residuals()
             print("residuals after ", i, "SQP_RTI iterations:\n", residuals)
 
-            self.solve_stats["timings"]["check_termination"][i] += perf_counter() - time_check_termination
-            self.solve_stats["timings"]["total"][i] += perf_counter() - time_iter
+            if profile:
+                time_now = perf_counter()
+                timings[Tkey.CHECK_TERMINATION,i] += time_now - time_check_termination
+                timings[Tkey.TOTAL,i] += time_now - time_iter
 
             if status != 0:
                 raise Exception('acados self.ocp_solver returned status {} in time step {}. Exiting.'.format(status, i))
@@ -313,12 +390,72 @@ class ZoroAcados():
         self.solve_stats["n_iter"] = i + 1
         self.solve_stats["timings_total"] = perf_counter() - time_total
 
+    def _create_cython_solver(self, solver_class, acados_obj, json_file, solver_type):
+        """
+        Generate and build the cython solver, unless an identical problem has
+        already been built into the code export directory.
+
+        solver_type: "ocp" or "sim"; there is one cython library per code export
+        directory and solver type, hence a single build stamp recording the json
+        file, hashes and built libraries (path, size, mtime) of the last build,
+        such that any other generate or build into the same directory invalidates it.
+        """
+        code_export_directory = acados_obj.code_export_directory
+        lib_patterns = [f"acados_{solver_type}_solver_pyx*", f"libacados_{solver_type}_solver_*"]
+        build_hash = get_acados_build_hash(acados_obj)
+        path_build_hash = os.path.join(code_export_directory, f".build_hash_{solver_type}")
+
+        def json_hash():
+            with open(json_file, "rb") as f:
+                return hashlib.sha256(f.read()).hexdigest()
+
+        def lib_stats():
+            paths = sorted(p for pattern in lib_patterns for p in glob(os.path.join(code_export_directory, pattern)))
+            return [f"{os.path.abspath(p)} {os.stat(p).st_size} {os.stat(p).st_mtime_ns}" for p in paths]
+
+        def build_stamp():
+            return [os.path.abspath(json_file), build_hash, json_hash()] + lib_stats()
+
+        is_built = False
+        if os.path.exists(path_build_hash) and os.path.exists(json_file) \
+            and all(len(glob(os.path.join(code_export_directory, pattern))) > 0 for pattern in lib_patterns):
+            with open(path_build_hash, "r") as f:
+                is_built = f.read().splitlines() == build_stamp()
+
+        if not is_built:
+            solver_class.generate(acados_obj, json_file = json_file)
+            solver_class.build(code_export_directory, with_cython=True)
+            with open(path_build_hash, "w") as f:
+                f.write("\n".join(build_stamp()))
+
+        return solver_class.create_cython_solver(json_file)
+
+    def enable_profiling(self):
+        """
+        Record timings in solve(), and synchronize CUDA around the GP evaluation
+        such that its timings are accurate.
+        """
+        self._profile = True
+
+    def _propagate_inplace(self, P_out, P_in, A, BWBT):
+        #  P_i+1 = A P A^T +  B*W*B^T, using preallocated buffers
+        np.matmul(A, P_in, out=self._AP)
+        np.matmul(self._AP, A.T, out=self._APAT)
+        np.add(self._APAT, BWBT, out=P_out)
+
     def set_model_params(self, i, p_model):
         self.p_hat_model[i,:] = p_model
         self.p_hat_model_with_Pvec[i,-self.nparam_model:] = p_model
         # print(f"Set model params (i={i}): p_hat_model={self.p_hat_model[i,:]},\nwith_Pvec={self.p_hat_model_with_Pvec[i,:]}")
 
     def get_solution(self):
+        # all stages in one call, if supported by the acados version
+        if hasattr(self.ocp_solver, "get_flat"):
+            X_flat = self.ocp_solver.get_flat("x")
+            U_flat = self.ocp_solver.get_flat("u")
+            if X_flat.size == (self.N+1)*self.nx and U_flat.size == self.N*self.nu:
+                return X_flat.reshape((self.N+1, self.nx)), U_flat.reshape((self.N, self.nu)), self.P_bar_all
+
         X = np.zeros((self.N+1, self.nx))
         U = np.zeros((self.N, self.nu))
 
@@ -332,20 +469,41 @@ class ZoroAcados():
         return X,U,self.P_bar_all
 
     def print_solve_stats(self):
+        """
+        Print the timings of the last solve(); these are only recorded after
+        enable_profiling(), otherwise all timings but the total are zero.
+        """
+        if not self._profile:
+            print("profiling disabled, call enable_profiling() to record timings")
         n_iter = self.solve_stats["n_iter"]
 
+        t_arr_all = self._timings_arr[:,0:n_iter]
+        t_sum_all = np.sum(t_arr_all, axis=1)
+        t_max_all = np.max(t_arr_all, axis=1)
+        t_min_all = np.min(t_arr_all, axis=1)
+
+        # timings contained in other timings, not subtracted from "other"
+        keys_nested = {
+            Tkey.INTEGRATE_ACADOS,
+            Tkey.GET_BACKOFFS_HTJ_SIG,
+            Tkey.GET_BACKOFFS_HTJ_SIG_MATMUL,
+            Tkey.GET_BACKOFFS_ADD,
+            Tkey.SOLVE_QP_ACADOS,
+        }
+
         time_other = 0.0
-        for key, t_arr in self.solve_stats["timings"].items():
-            for i in range(n_iter):
-                t_sum = np.sum(t_arr[0:n_iter])
-                t_avg = t_sum / n_iter
-                t_max = np.max(t_arr[0:n_iter])
-                t_min = np.min(t_arr[0:n_iter])
-                if key != "integrate_acados":
-                    if key != "total":
-                        time_other -= t_sum
-                    else:
-                        time_other += t_sum
+        for k in Tkey:
+            if k == Tkey.PHASE_ONE:
+                continue
+            key = k.name.lower()
+            t_sum = t_sum_all[k]
+            t_avg = t_sum / n_iter
+            t_max = t_max_all[k]
+            t_min = t_min_all[k]
+            if k == Tkey.TOTAL:
+                time_other += t_sum
+            elif k not in keys_nested:
+                time_other -= t_sum
             print(f"{key:20s}: {1000*t_sum:8.3f}ms ({n_iter} calls), {1000*t_avg:8.3f}/{1000*t_max:8.3f}/{1000*t_min:8.3f}ms (avg/max/min per call)")
 
         key = "other"
@@ -354,20 +512,31 @@ class ZoroAcados():
         print(f"{key:20s}: {1000*t:8.3f}ms ({n_iter} calls), {1000*t/n_iter:8.3f}ms (1 call)")
     
     def init_solve_stats(self, max_iter):
-        self.solve_stats = self.solve_stats_default.copy()
-        for k in self.solve_stats["timings"].keys():
-            self.solve_stats["timings"][k] = np.zeros((max_iter,))
+        self.solve_stats["n_iter"] = self.solve_stats_default["n_iter"]
+        self.solve_stats["timings_total"] = self.solve_stats_default["timings_total"]
+
+        if self._timings_arr is None or self._timings_arr.shape[1] != max_iter:
+            # contiguous timings, rows are views in self.solve_stats["timings"]
+            self._timings_arr = np.zeros((len(Tkey), max_iter))
+            for k in Tkey:
+                self.solve_stats["timings"][k.name.lower()] = self._timings_arr[k,:]
+        else:
+            self._timings_arr.fill(0.0)
     
     def get_solve_stats(self):
+        """
+        Return the solution and timings of the last solve(); timings are only
+        recorded after enable_profiling(), otherwise all but the total are zero.
+        """
         X,U,P = self.get_solution()
-        for k in self.solve_stats["timings"].keys():
-            self.solve_stats["timings"][k] = self.solve_stats["timings"][k][0:self.solve_stats["n_iter"]]
+        n_iter = self.solve_stats["n_iter"]
+        timings = {k.name.lower(): self._timings_arr[k,0:n_iter].copy() for k in Tkey if k != Tkey.PHASE_ONE}
 
         return ZoroAcadosData(
-            self.solve_stats["n_iter"], 
+            n_iter, 
             X, 
             U, 
             P, 
             self.solve_stats["timings_total"],
-            self.solve_stats["timings"].copy()
+            timings
         )
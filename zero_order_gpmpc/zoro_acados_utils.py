@@ -1,3 +1,6 @@
+import os
+import hashlib
+import subprocess
 from casadi import SX, MX, vertcat
 from acados_template import AcadosModel
 import torch
@@ -24,7 +27,7 @@ timings_names_default = [
     "get_backoffs_htj_sig_matmul",
     "get_backoffs_add",
     "set_tightening",
-    "phase_one",
+    # "phase_one",
     "check_termination",
     "solve_qp",
     "solve_qp_acados",
@@ -47,7 +50,7 @@ timings_names_raw = [
     "get_backoffs_htj_sig_matmul",
     "get_backoffs_add",
     "set_tightening",
-    "phase_one",
+    # "phase_one",
     "check_termination",
     # "solve_qp",
     "solve_qp_acados",
@@ -164,21 +167,29 @@ def plot_timings(solve_data:list, timings_names=timings_names_default):
 
     plt.show()
 
+# upper triangular indices, keyed by nx
+_triu_indices_np = {}
+
+def get_triu_indices(nx):
+    if nx not in _triu_indices_np:
+        _triu_indices_np[nx] = np.triu_indices(nx, m=nx)
+    return _triu_indices_np[nx]
+
 def sym_mat2vec(mat):
     nx = mat.shape[0]
 
     if isinstance(mat, np.ndarray):
-        i, j = np.triu_indices(nx, m=nx)
+        i, j = get_triu_indices(nx)
         return mat[i,j]
     elif isinstance(mat, torch.Tensor):
         i, j = torch.triu_indices(nx, nx)
         return mat[i,j]
     elif isinstance(mat, cas.DM):
         mat_np = np.array(mat)
-        i, j = np.triu_indices(nx, m=nx)
+        i, j = get_triu_indices(nx)
         return cas.DM(mat_np[i,j])
     else:
-        i, j = np.triu_indices(nx, m=nx)
+        i, j = get_triu_indices(nx)
         return mat[i,j]
 
 
@@ -186,13 +197,13 @@ def vec2sym_mat(vec, nx):
 
     if isinstance(vec, np.ndarray):
         mat = np.zeros((nx,nx))
-        i, j = np.triu_indices(nx, m=nx)
+        i, j = get_triu_indices(nx)
     elif isinstance(vec, torch.Tensor):
         mat = torch.zeros((nx,nx), device=vec.device)
         i, j = torch.triu_indices(nx, nx)
     else:
         mat = SX.zeros(nx,nx)
-        i, j = np.triu_indices(nx, m=nx)
+        i, j = get_triu_indices(nx)
 
     mat[i, j] = vec
     mat.T[i, j] = vec
@@ -234,13 +245,49 @@ def vec2sym_mat_old(vec, nx):
 
     return mat
 
-def generate_gp_funs(gp_model, covar_jac=False, B=None):
-    if gp_model.train_inputs[0].device.type == "cuda":
-        to_tensor = lambda X: torch.Tensor(X).cuda()
-        to_numpy = lambda T: T.cpu().numpy()
+def generate_gp_funs(gp_model, covar_jac=False, B=None, dtype=None, allow_tf32=False):
+    """
+    gp_model: GPyTorch GP model, cast to dtype (in place) if it differs from the model's dtype
+    dtype: floating point type of the GP evaluation, defaults to the dtype of the
+        model's training inputs; outputs are returned as float64
+    allow_tf32: use TF32 tensor cores for float32 matmuls on CUDA devices supporting it;
+        the matmul precision is only changed during the GP evaluation and restored afterwards
+    """
+    if dtype is None:
+        dtype = gp_model.train_inputs[0].dtype
+    elif gp_model.train_inputs[0].dtype != dtype:
+        gp_model.to(dtype)
+        # prediction caches of the previous dtype are recomputed
+        gp_model.prediction_strategy = None
+
+    use_cuda = gp_model.train_inputs[0].device.type == "cuda"
+    use_tf32 = use_cuda and allow_tf32 and dtype == torch.float32 \
+        and torch.cuda.get_device_capability(gp_model.train_inputs[0].device)[0] >= 8
+    if use_cuda:
+        to_tensor = lambda X: torch.as_tensor(X, dtype=dtype).cuda()
+        to_numpy = lambda T: T.cpu().to(torch.float64).numpy()
     else:
-        to_tensor = lambda X: torch.Tensor(X)
-        to_numpy = lambda T: T.numpy()
+        to_tensor = lambda X: torch.as_tensor(X, dtype=dtype)
+        to_numpy = lambda T: T.detach().to(torch.float64).numpy()
+
+    # persistent staging buffers for the GP inputs (allocated on first call)
+    y_buffers = {"pinned": None, "device": None}
+
+    def y_to_tensor(y):
+        if not use_cuda:
+            return to_tensor(y)
+
+        N = y.shape[0]
+        y_pinned = y_buffers["pinned"]
+        if y_pinned is None or y_pinned.shape[0] < N or y_pinned.shape[1:] != y.shape[1:]:
+            y_pinned = torch.empty(y.shape, dtype=gp_model.train_inputs[0].dtype, pin_memory=True)
+            y_buffers["pinned"] = y_pinned
+            y_buffers["device"] = torch.empty_like(y_pinned, device=gp_model.train_inputs[0].device)
+
+        y_pinned[:N].copy_(torch.from_numpy(y))
+        y_dev = y_buffers["device"][:N]
+        y_dev.copy_(y_pinned[:N], non_blocking=True)
+        return y_dev
 
     if B is not None:
         B_tensor = to_tensor(B)
@@ -262,22 +309,57 @@ def generate_gp_funs(gp_model, covar_jac=False, B=None):
             )
         return mean_dy
 
-    def gp_sensitivities(y):
+    def get_mean_dy_block_diag(mean, y):
+        # the mean at y[k] only depends on y[k], hence the jacobian of the
+        # stage-summed mean already is the stage-wise block diagonal;
+        # one backward pass per output through the same forward pass (batched
+        # backward passes are not supported by all linear_operator ops)
+        mean_sum = mean.sum(dim=0).reshape(-1)
+        n_out = mean_sum.shape[0]
+        mean_dy = torch.stack([
+            torch.autograd.grad(mean_sum[j], y, retain_graph=(j < n_out-1))[0]
+            for j in range(n_out)
+        ])
+        return mean_dy.reshape((*mean.shape[1:], *y.shape))
+
+    def _gp_sensitivities(y):
         # evaluate GP part (GP jacobians)
         with gpytorch.settings.fast_pred_var():
-            y_tensor = torch.autograd.Variable(to_tensor(y), requires_grad=True)
-            # DERIVATIVE
-            mean_dy = to_numpy(torch.autograd.functional.jacobian(
-                mean_fun_sum, 
-                y_tensor
-            ))
+            y_tensor = y_to_tensor(y).detach().requires_grad_(True)
+            predictions = gp_model(y_tensor) # only model (we want to find true function)
+
+            # DERIVATIVE (through the same forward pass)
+            mean_dy = get_mean_dy_block_diag(predictions.mean, y_tensor)
 
             with torch.no_grad():
-                predictions = gp_model(y_tensor) # only model (we want to find true function)
-                mean = to_numpy(predictions.mean)
-                variance = to_numpy(predictions.variance)
+                # variance is evaluated lazily, i.e., without building a graph
+                mean = predictions.mean.detach()
+                variance = predictions.variance
+
+                outputs = (mean, mean_dy, variance)
+                if not use_cuda:
+                    # no transfer on the CPU (and no copy for float64 models)
+                    return tuple(to_numpy(T) for T in outputs)
+
+                # single device-to-host copy for all outputs
+                outputs_np = np.split(
+                    to_numpy(torch.cat([T.reshape(-1) for T in outputs])),
+                    np.cumsum([T.numel() for T in outputs[:-1]])
+                )
+
+        return tuple(T_np.reshape(T.shape) for T_np, T in zip(outputs_np, outputs))
+
+    def gp_sensitivities(y):
+        if not use_tf32:
+            return _gp_sensitivities(y)
 
-        return mean, mean_dy, variance
+        # TF32 only for the GP evaluation, the process-wide setting is restored
+        matmul_precision = torch.get_float32_matmul_precision()
+        torch.set_float32_matmul_precision("high")
+        try:
+            return _gp_sensitivities(y)
+        finally:
+            torch.set_float32_matmul_precision(matmul_precision)
 
     def P_propagation_with_y(y, P_vec, A_nom, create_graph=False):
         variance = covar_fun(y)
@@ -339,6 +421,29 @@ def generate_gp_funs(gp_model, covar_jac=False, B=None):
     else:
         return gp_sensitivities
 
+def _hashable_repr(obj):
+    # deterministic representation of (nested) acados objects, no memory addresses
+    if isinstance(obj, (cas.SX, cas.MX, cas.DM)):
+        return str(obj)
+    elif isinstance(obj, cas.Function):
+        return obj.serialize()
+    elif isinstance(obj, np.ndarray):
+        return repr(obj.tolist())
+    elif isinstance(obj, dict):
+        return "{" + ", ".join(f"{k}: {_hashable_repr(v)}" for k, v in sorted(obj.items())) + "}"
+    elif isinstance(obj, (list, tuple)):
+        return "[" + ", ".join(_hashable_repr(v) for v in obj) + "]"
+    elif hasattr(obj, "__dict__"):
+        return type(obj).__name__ + _hashable_repr(vars(obj))
+    else:
+        return repr(obj)
+
+def get_acados_build_hash(acados_obj):
+    """
+    acados_obj: AcadosOcp or AcadosSim, before code generation
+    """
+    return hashlib.sha256(_hashable_repr(acados_obj).encode()).hexdigest()
+
 def transform_ocp(ocp_input):
     ocp = deepcopy(ocp_input)
 
@@ -368,27 +473,41 @@ def P_propagation(P, A, B, W):
     #  P_i+1 = A P A^T +  B*W*B^T
     return A @ P @ A.T + B @ W @ B.T 
 
-def generate_h_tighten_jac_sig_from_h_tighten(h_tight, x, u, p, sig):
-    # JIT options
-    jit_options = {"flags": ["-O3"], "verbose": True}
-    fun_options = {"jit": True, "compiler": "shell", "jit_options": jit_options}
-
+def compile_cached(fun, cache_dir=".cas_cache", flags=("-O3",)):
+    """
+    fun: cas.Function to be compiled
+    cache_dir: directory for generated code and shared libraries, which are
+        reused by all functions with the same name, expression and flags
+    """
+    fun_hash = hashlib.sha1((fun.serialize() + " ".join(flags)).encode()).hexdigest()[:16]
+    name = f"{fun.name()}_{fun_hash}"
+    lib_path = os.path.join(cache_dir, name + ".so")
+
+    if not os.path.exists(lib_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        codegen = cas.CodeGenerator(name + ".c")
+        codegen.add(fun)
+        c_path = codegen.generate(cache_dir + os.sep)
+        # build under temporary name, such that no partial library is loaded
+        lib_path_tmp = f"{lib_path}.{os.getpid()}.tmp"
+        subprocess.run(["gcc", "-fPIC", "-shared", *flags, c_path, "-o", lib_path_tmp], check=True)
+        os.replace(lib_path_tmp, lib_path)
+
+    return cas.external(fun.name(), lib_path)
+
+def generate_h_tighten_jac_sig_from_h_tighten(h_tight, x, u, p, sig, cache_dir=".cas_cache"):
     h_tighten_jac_sig = cas.jacobian(h_tight, sig)
 
     p_sig = cas.vertcat(sig, p)
-    h_tighten_jac_sig_fun = cas.Function("h_tighten_jac_sig", [x, u, p_sig], [h_tighten_jac_sig], fun_options)
+    h_tighten_jac_sig_fun = cas.Function("h_tighten_jac_sig", [x, u, p_sig], [h_tighten_jac_sig])
 
-    return h_tighten_jac_sig_fun
+    # MX -> SX for faster evaluation, then compile (or load previous build)
+    h_tighten_jac_sig_fun = compile_cached(h_tighten_jac_sig_fun.expand(), cache_dir=cache_dir)
 
-def generate_h_tightening_funs_SX(h, x, u, p, idh_tight):
-    """
-    h: cas.MX or cas.SX expression for contraints to be tightened depending on x
-    x: cas.MX or cas.SX variable
-    """
-    # JIT options
-    jit_options = {"flags": ["-O3"], "verbose": True}
-    fun_options = {"jit": True, "compiler": "shell", "jit_options": jit_options}
+    return h_tighten_jac_sig_fun
 
+def _generate_h_tightening_funs_sym(h, x, u, p, idh_tight):
+    # symbolic (not compiled) tightening functions, can be called with SX arguments
     # dims
     nx = x.shape[0]
     nu = u.shape[0]
@@ -411,13 +530,23 @@ def generate_h_tightening_funs_SX(h, x, u, p, idh_tight):
 
     p_sig = cas.vertcat(sig_vec, p)
 
-    h_jac_x_fun = cas.Function("h_jac_x",[x,u,p_sig],[h_jac_x],fun_options)
-    h_tighten_fun = cas.Function("h_tighten", [x,u,p_sig], [h_tighten_stack], fun_options)
-    h_tighten_jac_x_fun = cas.Function("h_tighten_jac_x", [x,u,p_sig], [h_tighten_jac_x], fun_options)
-    h_tighten_jac_sig_fun = cas.Function("h_tighten_jac_sig", [x,u,p_sig], [h_tighten_jac_sig], fun_options)
+    h_jac_x_fun = cas.Function("h_jac_x",[x,u,p_sig],[h_jac_x])
+    h_tighten_fun = cas.Function("h_tighten", [x,u,p_sig], [h_tighten_stack])
+    h_tighten_jac_x_fun = cas.Function("h_tighten_jac_x", [x,u,p_sig], [h_tighten_jac_x])
+    h_tighten_jac_sig_fun = cas.Function("h_tighten_jac_sig", [x,u,p_sig], [h_tighten_jac_sig])
 
     return p_sig, h_jac_x_fun, h_tighten_fun, h_tighten_jac_x_fun, h_tighten_jac_sig_fun
 
+def generate_h_tightening_funs_SX(h, x, u, p, idh_tight, cache_dir=".cas_cache"):
+    """
+    h: cas.MX or cas.SX expression for contraints to be tightened depending on x
+    x: cas.MX or cas.SX variable
+    cache_dir: directory for the compiled functions
+    returns p_sig and the compiled functions for numerical evaluation
+    """
+    p_sig, *funs_sym = _generate_h_tightening_funs_sym(h, x, u, p, idh_tight)
+    return (p_sig, *[compile_cached(fun, cache_dir=cache_dir) for fun in funs_sym])
+
 def only_upper_bounds_expr(h):
     h_only_upper = cas.vertcat(
         -h, # lower
@@ -433,19 +562,45 @@ def tighten_model_constraints(model, idh_tight, prob_x):
     u = model.u
     p = model.p
 
-    p_sig, h_jac_x_fun, h_tighten_fun, h_tighten_jac_x_fun, h_tighten_jac_sig_fun = generate_h_tightening_funs_SX(h, x, u, p, idh_tight)
+    p_sig, *funs_sym = _generate_h_tightening_funs_sym(h, x, u, p, idh_tight)
+    h_tighten_fun_sym = funs_sym[1]
+    # compiled twins for numerical evaluation
+    h_jac_x_fun, h_tighten_fun, h_tighten_jac_x_fun, h_tighten_jac_sig_fun = [compile_cached(fun) for fun in funs_sym]
     model.p = p_sig
 
     prob_tighten = norm.ppf(prob_x)
+    h_tighten = h_tighten_fun_sym(x, u, p_sig)
     for ih in idh_tight:
-        model.con_h_expr[ih] = model.con_h_expr[ih] - prob_tighten * h_tighten_fun(x, u, p_sig)[ih,:]
+        model.con_h_expr[ih] = model.con_h_expr[ih] - prob_tighten * h_tighten[ih,:]
     
     return model, h_jac_x_fun, h_tighten_fun, h_tighten_jac_x_fun, h_tighten_jac_sig_fun
 
+def eval_batch(fun, y_all, N_sim):
+    """
+    fun: constant matrix, cas.Function or callable of y, returning a matrix
+    returns fun evaluated at y_all[0:N_sim,:], stacked along the first axis
+    """
+    if isinstance(fun, np.ndarray):
+        return np.broadcast_to(fun, (N_sim, *fun.shape))
+    elif isinstance(fun, cas.Function):
+        n_row, n_col = fun.size_out(0)
+        # horizontally concatenated outputs of all steps
+        fun_all = fun.map(N_sim)(y_all[0:N_sim,:].T).full()
+        return fun_all.reshape((n_row, N_sim, n_col)).transpose((1,0,2))
+    else:
+        return np.stack([np.asarray(fun(y_all[i,:])) for i in range(N_sim)])
+
 def propagate(P0, Afun, B, Wfun, y_all, N_sim):
-    P_return = [np.zeros(P0.shape)] * (N_sim+1)
-    P_return[0] = P0
+    A_all = eval_batch(Afun, y_all, N_sim)
+    W_all = eval_batch(Wfun, y_all, N_sim)
+    BWBT_all = B @ W_all @ B.T
+
+    P_return = np.empty((N_sim+1, *P0.shape))
+    P_return[0,:,:] = P0
+    AP = np.empty(P0.shape)
     for i in range(N_sim):
-        y = y_all[i,:]
-        P_return[i+1] = P_propagation(P_return[i], Afun(y), B, Wfun(y))
+        #  P_i+1 = A P A^T +  B*W*B^T
+        np.matmul(A_all[i,:,:], P_return[i,:,:], out=AP)
+        np.matmul(AP, A_all[i,:,:].T, out=P_return[i+1,:,:])
+        P_return[i+1,:,:] += BWBT_all[i,:,:]
     return P_return
\ No newline at end of file